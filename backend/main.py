@@ -1,189 +1,80 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-import subprocess
-import tempfile
+import asyncio
+import math
 import os
+import re
+import json
+import time
+import base64
+import contextlib
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
 import google.generativeai as genai
 from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(sweep_cache_db)
+    yield
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["content-type"],
+    expose_headers=["X-OpenSCAD-Code"],
+    max_age=86400,
 )
 
+app.add_middleware(GZipMiddleware, minimum_size=4096, compresslevel=5)
+
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable is required. Create a .env file with GEMINI_API_KEY=your_key")
 
 genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash-exp')
-
-
-class PromptRequest(BaseModel):
-    prompt: str
-    current_code: Optional[str] = None
-    current_stl_data: Optional[str] = None
-    mesh_transforms: Optional[dict] = None
-    component_transforms: Optional[list] = None
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-exp'
 
+model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 
-class GenerateResponse(BaseModel):
-    stl_data: bytes
-    openscad_code: str
-
-
-def fix_common_syntax_errors(code: str) -> str:
-    import re
-    import math
-    
-    if 'PI' in code and 'PI =' not in code and 'PI=' not in code:
-        code = f"PI = {math.pi};\n\n" + code
-    
-    lines = code.split('\n')
-    fixed_lines = []
-    
-    for line in lines:
-        if line.strip().startswith('module ') and '(' in line:
-            fixed_lines.append(line)
-            continue
-        
-        if 'gear_module' not in line and 'gear_mod' not in line:
-            line = re.sub(r'\bmodule\s*=\s*', 'mod = ', line)
-            line = re.sub(r'([*/+\-])\s*module\b', r'\1 mod', line)
-            line = re.sub(r'\bmodule\s*([*/+\-])', r'mod \1', line)
-        
-        fixed_lines.append(line)
-    
-    return '\n'.join(fixed_lines)
-
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db"))
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_MEMORY_SIZE = 128
+CACHE_SWEEP_INTERVAL = 100
 
-def compile_openscad(openscad_code: str) -> tuple[bytes, str, str]:
-    fixed_code = fix_common_syntax_errors(openscad_code)
-    
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.scad', delete=False) as scad_file:
-        scad_path = scad_file.name
-        scad_file.write(fixed_code)
-    
-    stl_path = tempfile.mktemp(suffix='.stl')
-    
-    try:
-        result = subprocess.run(
-            ['openscad', scad_path, '-o', stl_path],
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
-        
-        if result.returncode != 0:
-            return None, fixed_code, result.stderr
-        
-        if not os.path.exists(stl_path) or os.path.getsize(stl_path) == 0:
-            return None, fixed_code, "OpenSCAD did not produce output"
-        
-        with open(stl_path, 'rb') as stl_file:
-            stl_data = stl_file.read()
-        
-        return stl_data, fixed_code, ""
-    
-    except subprocess.TimeoutExpired:
-        return None, fixed_code, "OpenSCAD compilation timed out (>60s). The model may be too complex. Try simplifying your request."
-    
-    finally:
-        if os.path.exists(scad_path):
-            os.unlink(scad_path)
-        if os.path.exists(stl_path):
-            os.unlink(stl_path)
+GENERATION_TEMPERATURES = (0.2, 0.7)
 
+OPENSCAD_POOL_SIZE = max(2, os.cpu_count() or 1)
+OPENSCAD_TIMEOUT_SECONDS = 60
 
-@app.post("/generate")
-async def generate_from_prompt(request: PromptRequest):
-    max_retries = 2
-    is_refinement = hasattr(request, 'current_code') and request.current_code
-    
-    for attempt in range(max_retries + 1):
-        try:
-            if attempt == 0:
-                if is_refinement:
-                    transforms_info = ""
-                    
-                    if hasattr(request, 'component_transforms') and request.component_transforms:
-                        transforms_info = "EXISTING COMPONENTS:\n"
-                        for idx, comp in enumerate(request.component_transforms):
-                            comp_id = comp.get('id', f'component-{idx+1}')
-                            pos = comp.get('position', {})
-                            scale = comp.get('scale', {})
-                            rot = comp.get('rotation', {})
-                            transforms_info += f"""
-{comp_id}:
-  Position: X={pos.get('x', 0)}mm, Y={pos.get('y', 0)}mm, Z={pos.get('z', 0)}mm
-  Scale: X={scale.get('x', 1)}, Y={scale.get('y', 1)}, Z={scale.get('z', 1)}
-  Rotation: X={rot.get('x', 0)}°, Y={rot.get('y', 0)}°, Z={rot.get('z', 0)}°
-"""
-                    elif hasattr(request, 'mesh_transforms') and request.mesh_transforms:
-                        transforms = request.mesh_transforms
-                        pos = transforms.get('position', {})
-                        scale = transforms.get('scale', {})
-                        rot = transforms.get('rotation', {})
-                        transforms_info = f"""
-CURRENT OBJECT TRANSFORMS:
-- Position: X={pos.get('x', 0)}mm, Y={pos.get('y', 0)}mm, Z={pos.get('z', 0)}mm
-- Scale: X={scale.get('x', 1)}, Y={scale.get('y', 1)}, Z={scale.get('z', 1)}
-- Rotation: X={rot.get('x', 0)}°, Y={rot.get('y', 0)}°, Z={rot.get('z', 0)}°
-"""
-                    
-                    prompt_text = f"""You are an expert OpenSCAD programmer tasked with REFINING existing code.
+openscad_slots = asyncio.Semaphore(OPENSCAD_POOL_SIZE)
 
-IMPORTANT: You are modifying an existing model. ONLY change what is mentioned in the new request.
-Preserve everything else. Do NOT regenerate the entire model unless explicitly asked.
+cache = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0}
+cache_puts = 0
 
-{transforms_info}
+cache_db_lock = threading.Lock()
 
-Current code:
-```
-{request.current_code}
-```
+cache_db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+cache_db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, stl BLOB, code TEXT, ts INTEGER)")
+cache_db.commit()
 
-New request: {request.prompt}
 
-POSITIONING RULES FOR MULTI-PART OBJECTS:
-- When adding new parts, position them RELATIVE to existing component positions
-- Use translate() to offset new parts from existing ones
-- Consider existing component transforms when calculating new part positions
-- If prompt says "add X on top of [component]", position above that component
-- If prompt says "add X next to [component]", position beside that component
-- If prompt says "connect X to [component]", align them appropriately
-
-RULES FOR REFINEMENT:
-1. Keep existing code structure and logic
-2. ONLY modify/add what the request mentions
-3. If asking to 'add', insert new parts without removing old ones
-4. Preserve all existing geometry and components
-3. If asking to "add", insert new parts without removing old ones
-4. If asking to "change", modify ONLY those specific parts
-5. If asking to "remove", comment out or delete ONLY those parts
-6. Preserve all working code that isn't mentioned
-
-SYNTAX RULES (CRITICAL):
-- Return ONLY OpenSCAD code, no markdown or backticks
-- All variables must be assigned before use
-- Each statement must end with semicolon ;
-- Maintain the same style and structure as the current code
-
-Refactored OpenSCAD code (with refinements applied):"""
-                else:
-                    prompt_text = f"""You are an expert OpenSCAD programmer. Generate SIMPLE, working OpenSCAD code.
-
-USER REQUEST: {request.prompt}
+INITIAL_SYSTEM_INSTRUCTION = """You are an expert OpenSCAD programmer. Generate SIMPLE, working OpenSCAD code for the USER REQUEST.
 
 ALLOWED FUNCTIONS - USE ONLY THESE:
 ✓ cube([x, y, z], center=true or false)
@@ -254,10 +145,10 @@ linear_extrude(height=20)
 
 Example 6 - Difference (cube with hole):
 $fn = 50;
-difference() {{
+difference() {
   cube([40, 40, 40], center=true);
   cylinder(h=50, r=8, center=true);
-}}
+}
 
 RULES TO PREVENT ERRORS:
 1. Always use center=true or center=false explicitly
@@ -276,17 +167,58 @@ RULES TO PREVENT ERRORS:
    - Wedge => Use rotated cube or cylinder
 
 RETURN ONLY the OpenSCAD code. No markdown, no backticks, no explanations."""
-            else:
-                refinement_note = " (refinement)" if is_refinement else ""
-                prompt_text = f"""The previous OpenSCAD code had a compilation error{refinement_note}. FIX IT NOW.
 
-Original request: {request.prompt}
+INITIAL_PROMPT_TEMPLATE = """USER REQUEST: {USER_REQUEST}"""
+
+REFINE_PROMPT_TEMPLATE = """You are an expert OpenSCAD programmer tasked with REFINING existing code.
+
+IMPORTANT: You are modifying an existing model. ONLY change what is mentioned in the new request.
+Preserve everything else. Do NOT regenerate the entire model unless explicitly asked.
+
+{TRANSFORMS_INFO}
+
+Current code:
+```
+{CURRENT_CODE}
+```
+
+New request: {USER_REQUEST}
+
+POSITIONING RULES FOR MULTI-PART OBJECTS:
+- When adding new parts, position them RELATIVE to existing component positions
+- Use translate() to offset new parts from existing ones
+- Consider existing component transforms when calculating new part positions
+- If prompt says "add X on top of [component]", position above that component
+- If prompt says "add X next to [component]", position beside that component
+- If prompt says "connect X to [component]", align them appropriately
+
+RULES FOR REFINEMENT:
+1. Keep existing code structure and logic
+2. ONLY modify/add what the request mentions
+3. If asking to 'add', insert new parts without removing old ones
+4. Preserve all existing geometry and components
+3. If asking to "add", insert new parts without removing old ones
+4. If asking to "change", modify ONLY those specific parts
+5. If asking to "remove", comment out or delete ONLY those parts
+6. Preserve all working code that isn't mentioned
+
+SYNTAX RULES (CRITICAL):
+- Return ONLY OpenSCAD code, no markdown or backticks
+- All variables must be assigned before use
+- Each statement must end with semicolon ;
+- Maintain the same style and structure as the current code
+
+Refactored OpenSCAD code (with refinements applied):"""
+
+FIX_PROMPT_TEMPLATE = """The previous OpenSCAD code had a compilation error{REFINEMENT_NOTE}. FIX IT NOW.
+
+Original request: {USER_REQUEST}
 
 Previous code:
-{openscad_code}
+{PREVIOUS_CODE}
 
 Compilation error:
-{compilation_error}
+{COMPILATION_ERROR}
 
 FIX IMMEDIATELY:
 1. Remove any complex math (PI, sin, cos, tan, sqrt)
@@ -307,29 +239,441 @@ REWRITE the code keeping it SIMPLE:
 
 Return ONLY corrected OpenSCAD code, no explanations."""
 
-            response = model.generate_content(prompt_text)
-            openscad_code = response.text.strip()
-            
-            if openscad_code.startswith("```"):
-                lines = openscad_code.split("\n")
-                openscad_code = "\n".join(lines[1:-1]) if len(lines) > 2 else openscad_code
-                openscad_code = openscad_code.replace("```openscad", "").replace("```", "").strip()
+_PROMPT_PLACEHOLDER = re.compile(r'\{([A-Z_]+)\}')
+
+rules_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=INITIAL_SYSTEM_INSTRUCTION)
+
+
+class PromptRequest(BaseModel):
+    prompt: str
+    current_code: Optional[str] = None
+    current_stl_data: Optional[str] = None
+    mesh_transforms: Optional[dict] = None
+    component_transforms: Optional[list] = None
+
+
+def render_prompt(template: str, **values: str) -> str:
+    return _PROMPT_PLACEHOLDER.sub(lambda m: str(values.get(m[1], m[0])), template)
+
+
+def build_transforms_info(request: PromptRequest) -> str:
+    transforms_info = ""
+    
+    if request.component_transforms:
+        transforms_info = "EXISTING COMPONENTS:\n"
+        for idx, comp in enumerate(request.component_transforms):
+            comp_id = comp.get('id', f'component-{idx+1}')
+            pos = comp.get('position', {})
+            scale = comp.get('scale', {})
+            rot = comp.get('rotation', {})
+            transforms_info += f"""
+{comp_id}:
+  Position: X={pos.get('x', 0)}mm, Y={pos.get('y', 0)}mm, Z={pos.get('z', 0)}mm
+  Scale: X={scale.get('x', 1)}, Y={scale.get('y', 1)}, Z={scale.get('z', 1)}
+  Rotation: X={rot.get('x', 0)}°, Y={rot.get('y', 0)}°, Z={rot.get('z', 0)}°
+"""
+    elif request.mesh_transforms:
+        transforms = request.mesh_transforms
+        pos = transforms.get('position', {})
+        scale = transforms.get('scale', {})
+        rot = transforms.get('rotation', {})
+        transforms_info = f"""
+CURRENT OBJECT TRANSFORMS:
+- Position: X={pos.get('x', 0)}mm, Y={pos.get('y', 0)}mm, Z={pos.get('z', 0)}mm
+- Scale: X={scale.get('x', 1)}, Y={scale.get('y', 1)}, Z={scale.get('z', 1)}
+- Rotation: X={rot.get('x', 0)}°, Y={rot.get('y', 0)}°, Z={rot.get('z', 0)}°
+"""
+    
+    return transforms_info
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r'\s+', ' ', prompt.strip().lower())
+
+
+def make_cache_key(request: PromptRequest) -> str:
+    payload = {
+        "p": normalize_prompt(request.prompt),
+        "c": request.current_code,
+        "mt": request.mesh_transforms,
+        "ct": request.component_transforms,
+        "attempt": 0,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def cache_get(key: str) -> Optional[tuple[bytes, str]]:
+    now = int(time.time())
+    entry = cache.get(key)
+    if entry and now - entry[2] < CACHE_TTL_SECONDS:
+        cache.move_to_end(key)
+        return entry[0], entry[1]
+    cache.pop(key, None)
+
+    row = await asyncio.to_thread(_cache_db_get, key, now - CACHE_TTL_SECONDS)
+    if not row:
+        return None
+
+    _remember(key, row[0], row[1], row[2])
+    return row[0], row[1]
+
+
+async def cache_put(key: str, stl_data: bytes, code: str) -> None:
+    global cache_puts
+
+    ts = int(time.time())
+    _remember(key, stl_data, code, ts)
+    await asyncio.to_thread(_cache_db_put, key, stl_data, code, ts)
+
+    cache_puts += 1
+    if cache_puts % CACHE_SWEEP_INTERVAL == 0:
+        await asyncio.to_thread(sweep_cache_db)
+
+
+def _cache_db_get(key: str, oldest_ts: int) -> Optional[tuple[bytes, str, int]]:
+    with cache_db_lock:
+        return cache_db.execute(
+            "SELECT stl, code, ts FROM cache WHERE key = ? AND ts >= ?",
+            (key, oldest_ts)
+        ).fetchone()
+
+
+def _cache_db_put(key: str, stl_data: bytes, code: str, ts: int) -> None:
+    with cache_db_lock:
+        cache_db.execute(
+            "INSERT OR REPLACE INTO cache (key, stl, code, ts) VALUES (?, ?, ?, ?)",
+            (key, stl_data, code, ts)
+        )
+        cache_db.commit()
+
+
+def sweep_cache_db() -> None:
+    with cache_db_lock:
+        cache_db.execute("DELETE FROM cache WHERE ts < ?", (int(time.time()) - CACHE_TTL_SECONDS,))
+        cache_db.commit()
+
+
+def _remember(key: str, stl_data: bytes, code: str, ts: int) -> None:
+    cache[key] = (stl_data, code, ts)
+    cache.move_to_end(key)
+    while len(cache) > CACHE_MEMORY_SIZE:
+        cache.popitem(last=False)
+
+
+_NUM = r'(\d+(?:\.\d+)?)\s*(?:mm)?'
+_ARTICLE = r'^(?:an? )?'
+
+TEMPLATE_MIN_MM = 1
+TEMPLATE_MAX_MM = 500
+
+TEMPLATES = {
+    "cube": "$fn = 50;\ncube([{x}, {y}, {z}], center=true);",
+    "sphere": "$fn = 50;\nsphere(r={r});",
+    "cylinder": "$fn = 50;\ncylinder(h={h}, r={r}, center=false);",
+    "prism": "$fn = 50;\nlinear_extrude(height={h})\n  polygon(points=[[0,0], [{s},0], [{half},{rise}]]);",
+}
+
+_LOCAL_PATTERNS = [
+    (re.compile(rf'{_ARTICLE}(?:cube|box)(?: of)?(?: size| side)?\s*=?\s*{_NUM}$'),
+     lambda m: ("cube", {"x": m[1], "y": m[1], "z": m[1]})),
+    (re.compile(rf'{_ARTICLE}(?:cube|box)\s*{_NUM}\s*x\s*{_NUM}\s*x\s*{_NUM}$'),
+     lambda m: ("cube", {"x": m[1], "y": m[2], "z": m[3]})),
+    (re.compile(rf'{_ARTICLE}(?:sphere|ball)(?: with)?\s*(?:r|radius)\s*=?\s*{_NUM}$'),
+     lambda m: ("sphere", {"r": m[1]})),
+    (re.compile(rf'{_ARTICLE}(?:sphere|ball)(?: with)?\s*(?:d|diameter)\s*=?\s*{_NUM}$'),
+     lambda m: ("sphere", {"r": _fmt(float(m[1]) / 2)})),
+    (re.compile(rf'{_ARTICLE}cylinder(?: with)?\s*(?:h|height)\s*=?\s*{_NUM},?(?: and)?\s*(?:r|radius)\s*=?\s*{_NUM}$'),
+     lambda m: ("cylinder", {"h": m[1], "r": m[2]})),
+    (re.compile(rf'{_ARTICLE}cylinder(?: with)?\s*(?:r|radius)\s*=?\s*{_NUM},?(?: and)?\s*(?:h|height)\s*=?\s*{_NUM}$'),
+     lambda m: ("cylinder", {"h": m[2], "r": m[1]})),
+    (re.compile(rf'{_ARTICLE}(?:triangular )?prism(?: with)?\s*(?:s|side)\s*=?\s*{_NUM},?(?: and)?\s*(?:h|height)\s*=?\s*{_NUM}$'),
+     lambda m: ("prism", {"s": m[1], "h": m[2], "half": _fmt(float(m[1]) / 2), "rise": _fmt(float(m[1]) * 0.866)})),
+]
+
+
+_TEMPLATE_POINT_KEYS = {"half", "rise"}
+
+_FILLER_WORDS = re.compile(r'\b(?:please|make|create|generate|build|draw|me|simple|basic|solid|plain|3d|model)\b')
+
+
+def _fmt(value: float) -> str:
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+
+def _match_template(normalized: str) -> Optional[str]:
+    for pattern, build in _LOCAL_PATTERNS:
+        match = pattern.match(normalized)
+        if not match:
+            continue
+        shape, dims = build(match)
+        if all(TEMPLATE_MIN_MM <= float(value) <= TEMPLATE_MAX_MM
+               for key, value in dims.items() if key not in _TEMPLATE_POINT_KEYS):
+            return TEMPLATES[shape].format(**dims)
+    return None
+
+
+def try_local_template(prompt: str) -> Optional[tuple[str, bool]]:
+    normalized = normalize_prompt(prompt)
+    code = _match_template(normalized)
+    if code:
+        return code, True
+    
+    loose = normalize_prompt(_FILLER_WORDS.sub(' ', normalized))
+    if loose != normalized:
+        code = _match_template(loose)
+        if code:
+            return code, False
+    return None
+
+
+_MODULE_FIXES = (
+    (re.compile(r'\bmodule\s*=\s*'), 'mod = '),
+    (re.compile(r'([*/+\-])\s*module\b'), r'\1 mod'),
+    (re.compile(r'\bmodule\s*([*/+\-])'), r'mod \1'),
+)
+_MODULE_LINE = re.compile(r'^.*module.*$', re.MULTILINE)
+_PI_ASSIGNMENT = re.compile(r'\bPI\s*=')
+_PI_LITERAL = f"PI = {math.pi};\n\n"
+
+
+def _fix_module_line(match: re.Match) -> str:
+    line = match.group(0)
+    if 'gear_module' in line or 'gear_mod' in line:
+        return line
+    if line.strip().startswith('module ') and '(' in line:
+        return line
+    for pattern, replacement in _MODULE_FIXES:
+        line = pattern.sub(replacement, line)
+    return line
+
+
+def fix_common_syntax_errors(code: str) -> str:
+    if 'PI' in code and not _PI_ASSIGNMENT.search(code):
+        code = _PI_LITERAL + code
+    
+    if 'module' not in code:
+        return code
+    
+    return _MODULE_LINE.sub(_fix_module_line, code)
+
+
+_FORBIDDEN_CALL = re.compile(r'\b(polyhedron|hull|minkowski|multmatrix|mirror|rotate_extrude|children)\s*\(')
+_TRAILING_IMPORTS = re.compile(r'(?:^[ \t]*(?:include|use)[ \t]*<[^>\n]*>[ \t]*;?\s*)+\Z', re.MULTILINE)
+_COMMENT_OR_STRING = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"', re.DOTALL)
+
+
+def _strip_comments_and_strings(code: str) -> str:
+    return _COMMENT_OR_STRING.sub(lambda m: '""' if m.group(0).startswith('"') else ' ', code)
+
+
+def prevalidate(code: str, enforce_allow_list: bool = False) -> Optional[str]:
+    stripped = _strip_comments_and_strings(code)
+    
+    if enforce_allow_list:
+        forbidden = _FORBIDDEN_CALL.search(stripped)
+        if forbidden:
+            return f"prevalidator: used forbidden function {forbidden.group(1)}()"
+    
+    for opening, closing in (('{', '}'), ('[', ']'), ('(', ')')):
+        if stripped.count(opening) != stripped.count(closing):
+            return f"prevalidator: unbalanced '{opening}' and '{closing}'"
+    
+    stripped = stripped.rstrip()
+    if not stripped:
+        return "prevalidator: no OpenSCAD code was generated"
+    
+    last_statement = _TRAILING_IMPORTS.sub('', stripped).rstrip()
+    if last_statement and last_statement[-1] not in ';}':
+        return "prevalidator: last statement is missing a semicolon ;"
+    
+    return None
+
+
+async def compile_openscad(openscad_code: str, enforce_allow_list: bool = False) -> tuple[bytes, str, str]:
+    fixed_code = fix_common_syntax_errors(openscad_code)
+    
+    validation_error = prevalidate(fixed_code, enforce_allow_list)
+    if validation_error:
+        return None, fixed_code, validation_error
+    
+    async with openscad_slots:
+        proc = await asyncio.create_subprocess_exec(
+            'openscad', '-', '-o', '-', '--export-format', 'binstl',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        try:
+            stl_data, stderr = await asyncio.wait_for(
+                proc.communicate(fixed_code.encode()),
+                timeout=OPENSCAD_TIMEOUT_SECONDS
+            )
+        except asyncio.CancelledError:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            raise
+        except asyncio.TimeoutError:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            return None, fixed_code, "OpenSCAD compilation timed out (>60s). The model may be too complex. Try simplifying your request."
+    
+    if proc.returncode != 0:
+        return None, fixed_code, stderr.decode(errors='replace')
+    
+    if not stl_data:
+        return None, fixed_code, "OpenSCAD did not produce output"
+    
+    return stl_data, fixed_code, ""
+
+
+def build_initial_prompt(request: PromptRequest, is_refinement: bool) -> str:
+    if is_refinement:
+        return render_prompt(
+            REFINE_PROMPT_TEMPLATE,
+            TRANSFORMS_INFO=build_transforms_info(request),
+            CURRENT_CODE=request.current_code,
+            USER_REQUEST=request.prompt
+        )
+    return render_prompt(INITIAL_PROMPT_TEMPLATE, USER_REQUEST=request.prompt)
+
+
+async def ask_gemini(gemini_model: genai.GenerativeModel, prompt_text: str, temperature: Optional[float] = None) -> str:
+    try:
+        generation_config = {"temperature": temperature} if temperature is not None else None
+        response = await gemini_model.generate_content_async(prompt_text, generation_config=generation_config)
+        openscad_code = response.text.strip()
+        
+        if openscad_code.startswith("```"):
+            lines = openscad_code.split("\n")
+            openscad_code = "\n".join(lines[1:-1]) if len(lines) > 2 else openscad_code
+            openscad_code = openscad_code.replace("```openscad", "").replace("```", "").strip()
+        
+        return openscad_code
+    
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Gemini API error: {str(e)}"
+        )
+
+
+async def generate_and_compile(
+    gemini_model: genai.GenerativeModel,
+    prompt_text: str,
+    temperature: float,
+    enforce_allow_list: bool
+) -> tuple[bytes, str, str]:
+    openscad_code = await ask_gemini(gemini_model, prompt_text, temperature)
+    return await compile_openscad(openscad_code, enforce_allow_list)
+
+
+async def generate_candidates(
+    gemini_model: genai.GenerativeModel,
+    prompt_text: str,
+    enforce_allow_list: bool = False
+) -> tuple[bytes, str, str]:
+    tasks = [
+        asyncio.create_task(generate_and_compile(gemini_model, prompt_text, temperature, enforce_allow_list))
+        for temperature in GENERATION_TEMPERATURES
+    ]
+    failure = None
+    gemini_error = None
+    
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except HTTPException as e:
+                gemini_error = gemini_error or e
+                continue
             
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Gemini API error: {str(e)}"
+            if result[0]:
+                return result
+            failure = failure or result
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    if failure is None:
+        raise gemini_error
+    return failure
+
+
+async def race_template(template_code: str, candidates_task: asyncio.Task) -> tuple[bytes, str, str]:
+    template_task = asyncio.create_task(compile_openscad(template_code))
+    pending = {template_task, candidates_task}
+    
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception() and task.result()[0]:
+                    return task.result()
+        return await candidates_task
+    finally:
+        template_task.cancel()
+        candidates_task.cancel()
+
+
+def stl_response(stl_data: bytes, openscad_code: str) -> Response:
+    return Response(
+        content=stl_data,
+        media_type='application/octet-stream',
+        headers={"X-OpenSCAD-Code": base64.b64encode(openscad_code.encode()).decode('ascii')}
+    )
+
+
+@app.post("/generate")
+async def generate_from_prompt(request: PromptRequest):
+    max_retries = 2
+    is_refinement = bool(request.current_code)
+    
+    cache_key = make_cache_key(request)
+    cached = await cache_get(cache_key)
+    if cached:
+        cache_stats["hits"] += 1
+        return stl_response(cached[0], cached[1])
+    cache_stats["misses"] += 1
+    
+    for attempt in range(max_retries + 1):
+        if attempt == 0:
+            prompt_text = build_initial_prompt(request, is_refinement)
+        else:
+            prompt_text = render_prompt(
+                FIX_PROMPT_TEMPLATE,
+                REFINEMENT_NOTE=" (refinement)" if is_refinement else "",
+                USER_REQUEST=request.prompt,
+                PREVIOUS_CODE=openscad_code,
+                COMPILATION_ERROR=compilation_error
             )
         
-        stl_data, fixed_code, compilation_error = compile_openscad(openscad_code)
+        first_generation = attempt == 0 and not is_refinement
+        template = try_local_template(request.prompt) if first_generation else None
+        
+        if template and template[1]:
+            stl_data, fixed_code, compilation_error = await compile_openscad(template[0])
+            if stl_data:
+                await cache_put(cache_key, stl_data, fixed_code)
+                return stl_response(stl_data, fixed_code)
+        
+        gemini_model = rules_model if first_generation else model
+        candidates_task = asyncio.create_task(generate_candidates(gemini_model, prompt_text, first_generation))
+        
+        try:
+            if template and not template[1]:
+                stl_data, fixed_code, compilation_error = await race_template(template[0], candidates_task)
+            else:
+                stl_data, fixed_code, compilation_error = await candidates_task
+        except BaseException:
+            candidates_task.cancel()
+            raise
         
         if stl_data:
-            import base64
-            response_data = {
-                "stl_data": base64.b64encode(stl_data).decode('utf-8'),
-                "openscad_code": fixed_code
-            }
-            return response_data
+            await cache_put(cache_key, stl_data, fixed_code)
+            return stl_response(stl_data, fixed_code)
         
         openscad_code = fixed_code
         
@@ -342,6 +686,17 @@ Return ONLY corrected OpenSCAD code, no explanations."""
             )
 
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    total = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        "hits": cache_stats["hits"],
+        "misses": cache_stats["misses"],
+        "hit_rate": cache_stats["hits"] / total if total else 0.0,
+        "memory_entries": len(cache)
+    }
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
@@ -18,7 +18,7 @@ export default function Home() {
   const [generatedCode, setGeneratedCode] = useState('');
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
-  const [currentStlData, setCurrentStlData] = useState<string | null>(null);
+  const [currentStlData, setCurrentStlData] = useState<ArrayBuffer | null>(null);
   const [position, setPosition] = useState({ x: 0, y: 0, z: 0 });
   const [scale, setScale] = useState({ x: 1, y: 1, z: 1 });
   const [rotation, setRotation] = useState({ x: 0, y: 0, z: 0 });
@@ -111,7 +111,6 @@ export default function Home() {
       const requestBody: any = { prompt: prompt };
       
       if (currentStlData && generatedCode) {
-        requestBody.current_stl_data = currentStlData;
         requestBody.current_code = generatedCode;
       }
       
@@ -128,12 +127,14 @@ export default function Home() {
         throw new Error(errorText);
       }
 
-      const data = await response.json();
-      
-      const stlBinary = Uint8Array.from(atob(data.stl_data), c => c.charCodeAt(0));
+      const stlBuffer = await response.arrayBuffer();
+      const encodedCode = response.headers.get('X-OpenSCAD-Code') || '';
+      const openscadCode = new TextDecoder().decode(
+        Uint8Array.from(atob(encodedCode), c => c.charCodeAt(0))
+      );
       
-      setGeneratedCode(data.openscad_code);
-      setCurrentStlData(data.stl_data);
+      setGeneratedCode(openscadCode);
+      setCurrentStlData(stlBuffer);
 
       if (meshRef.current && sceneRef.current) {
         sceneRef.current.remove(meshRef.current);
@@ -142,7 +143,7 @@ export default function Home() {
       }
 
       const loader = new STLLoader();
-      const geometry = loader.parse(stlBinary.buffer);
+      const geometry = loader.parse(stlBuffer);
 
       geometry.computeBoundingBox();
       if (geometry.boundingBox) {